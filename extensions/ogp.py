@@ -1,47 +1,78 @@
 import asyncio
+import codecs
+import io
 import re
-import subprocess
-import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 from urllib.parse import urlparse
 
-import bs4
-import requests
-from aiohttp import ClientSession
-from discord import Embed, File, Message
+from aiohttp import ClientResponse, ClientSession, TCPConnector
+from discord import Embed, File, HTTPException, Message
+from discord.abc import Messageable
 from discord.ext.commands import Bot
+from lxml import etree
+from PIL import Image
 
 GSNET_URL_PATTERN = re.compile(r"http://10\.\d{,3}\.\d{,3}\.\d{,3}[-\w./()?%&=!~#]*")
 BOT_HEDERS = {"User-Agent": "6ZeH44Gu5omL44GM5p2l44Gf44KI44CcCg=="}
+HTML_READ_LIMIT = 256 * 1024
+# Discord の制限
+MAX_EMBED_TITLE_LENGTH = 256
+MAX_EMBED_DESCRIPTION_LENGTH = 4096
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBEDS_TOTAL_LENGTH = 6000
+DEFAULT_FILESIZE_LIMIT = 8 * 1024 * 1024
 
 
-def save_file(url: str, file_path: Path) -> None:
-    response = requests.get(url, headers=BOT_HEDERS)
-    response.raise_for_status()
-    with open(file_path, "wb") as f:
-        f.write(response.content)
+class SessionHolder:
+    # URL ごとに作り直すと毎回接続し直すので、ひとつのセッションを使い回す
+    def __init__(self) -> None:
+        self.session: Optional[ClientSession] = None
 
+    def get(self) -> ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                headers=BOT_HEDERS,
+                connector=TCPConnector(limit=32, keepalive_timeout=75),
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+session_holder = SessionHolder()
+
+
+async def download(url: str) -> bytes:
+    async with session_holder.get().get(url) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+def convert_ico_to_png(ico: bytes) -> bytes:
+    # Pillow は ICO の中で一番大きい画像を開いてくれる
+    with Image.open(io.BytesIO(ico)) as image:
+        png = io.BytesIO()
+        image.save(png, format="PNG")
+    return png.getvalue()
+
+
+async def get_png_favicon_file(favicon_url: str, prefix: str = "") -> File:
+    favicon = await download(favicon_url)
+    favicon_png = await asyncio.to_thread(convert_ico_to_png, favicon)
+    return File(io.BytesIO(favicon_png), filename=f"{prefix}favicon.png")
 
-def get_png_favicon_file(favicon_url: str, directory: Path) -> File:
-    favicon_path = Path(directory) / "favicon.ico"
-    save_file(favicon_url, favicon_path)
-    res = subprocess.run(
-        ["./extract-ico.sh"],
-        input=bytes(favicon_path),
-        capture_output=True,
-        check=True,
-    )
-    favicon_png_path = Path(res.stdout.decode().rstrip())
-    return File(favicon_png_path, filename="favicon.png")
 
+async def get_ogp_file(image_url: str, prefix: str = "") -> File:
+    file_name = prefix + Path(urlparse(image_url).path).name
+    return File(io.BytesIO(await download(image_url)), filename=file_name)
 
-def get_ogp_file(image_url: str, directory: Path) -> File:
-    file_name = Path(urlparse(image_url).path).name
-    file_path = Path(directory) / file_name
-    save_file(image_url, file_path)
-    return File(file_path, filename=file_name)
+
+def truncate(text: str, length: int) -> str:
+    return text if len(text) <= length else text[: length - 1] + "…"
 
 
 @dataclass
@@ -54,7 +85,9 @@ class PageInfo:
 
     def to_embed(self) -> Embed:
         embed = Embed(
-            title=self.title, url=self.url, description=self.description or ""
+            title=truncate(self.title, MAX_EMBED_TITLE_LENGTH),
+            url=self.url,
+            description=truncate(self.description or "", MAX_EMBED_DESCRIPTION_LENGTH),
         )
         if self.image_url is None:
             parsed_url = urlparse(self.url)
@@ -67,74 +100,163 @@ class PageInfo:
 class Page:
     url: str
     html: bytes
+    charset: Optional[str] = None  # Content-Type で指定された文字コード
 
     def get_info(self) -> PageInfo:
-        soup = bs4.BeautifulSoup(self.html, "lxml")
-
-        if title_tag := soup.select_one(r"meta[property=og\:title]"):
-            title = title_tag["content"]
-        elif title_tag := soup.select_one("title"):
-            title = title_tag.text
+        # 欲しいのは <head> の中の数タグだけなので、bs4 を挟まず lxml で直接引く
+        if (head_end := self.html.find(b"</head>")) != -1:
+            html = self.html[: head_end + len(b"</head>")]
         else:
-            title = self.url[7:]  # http:// を消す
-
-        if description_tag := soup.select_one(r"meta[property=og\:description]"):
-            description = description_tag["content"]
+            html = self.html
+        root = etree.HTML(html, get_html_parser(html, self.charset))
+        if root is None:  # 空のページ
+            root = etree.Element("html")
+
+        if (og_title := get_meta_content(root, "og:title")) is not None:
+            title = og_title
+        elif (title_text := root.findtext(".//title")) is not None:
+            title = title_text
         else:
-            description = None
+            title = self.url[7:]  # http:// を消す
 
-        if image_tag := soup.select_one(r"meta[property=og\:image]"):
-            image_url = image_tag["content"]
-        else:
-            image_url = None
+        description = get_meta_content(root, "og:description")
+        image_url = get_meta_content(root, "og:image")
 
         return PageInfo(title, self.url, description, image_url)
 
 
-def get_gsnet_urls(string: str) -> list[str]:
-    return GSNET_URL_PATTERN.findall(string)
+def get_html_parser(html: bytes, charset: Optional[str]) -> etree.HTMLParser:
+    if charset is not None:
+        try:
+            return etree.HTMLParser(encoding=charset)
+        except LookupError:  # libxml2 の知らない文字コード
+            pass
+    # libxml2 は文字コードの分からない HTML を Latin-1 として読んでしまうので、
+    # UTF-8 として読めるなら UTF-8 にする (途中で切れた末尾の文字は気にしない)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(html, final=False)
+    except UnicodeDecodeError:
+        return etree.HTMLParser()  # <meta charset> があれば libxml2 がそれに従う
+    return etree.HTMLParser(encoding="utf-8")
+
+
+def get_meta_content(root: etree._Element, prop: str) -> Optional[str]:
+    contents = root.xpath("//meta[@property=$prop]/@content", prop=prop)
+    return str(contents[0]) if contents else None
+
+
+def get_gsnet_urls(string: str) -> Iterator[str]:
+    return (match.group() for match in GSNET_URL_PATTERN.finditer(string))
+
+
+async def read_head(response: ClientResponse) -> bytes:
+    # OGP のタグは <head> にしかないので、</head> まで読めたら残りは捨てる
+    html = bytearray()
+    async for chunk in response.content.iter_chunked(8192):
+        search_from = max(len(html) - len(b"</head>"), 0)
+        html += chunk
+        if html.find(b"</head>", search_from) != -1 or len(html) >= HTML_READ_LIMIT:
+            break
+    return bytes(html)
 
 
 async def get_page(url: str) -> Optional[Page]:
-    async with ClientSession(headers=BOT_HEDERS) as session:
-        try:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    return None
-                return Page(url, await response.read())
-        except:  # うまく取れないものは全て要らないので、握りつぶして殺す
-            return None
+    try:
+        async with session_holder.get().get(url) as response:
+            if response.status != 200:
+                return None
+            return Page(url, await read_head(response), response.charset)
+    except:  # うまく取れないものは全て要らないので、握りつぶして殺す
+        return None
+
+
+async def attach_file(embed: Embed, info: PageInfo, index: int) -> Optional[File]:
+    # まとめて 1 つのメッセージで送るので、添付ファイル名が被らないように番号を付ける
+    try:
+        if info.image_url is not None:
+            file = await get_ogp_file(info.image_url, f"{index}-")
+            embed.set_image(url=f"attachment://{file.filename}")
+        else:
+            file = await get_png_favicon_file(info.favicon_url, f"{index}-")
+            embed.set_thumbnail(url=f"attachment://{file.filename}")
+    except:
+        return None
+    return file
+
+
+def split_previews(
+    previews: list[tuple[Embed, Optional[File]]], filesize_limit: int
+) -> Iterator[list[tuple[Embed, Optional[File]]]]:
+    # 1 つのメッセージに載る埋め込みの数・文字数と添付ファイルの合計サイズに収める
+    batch: list[tuple[Embed, Optional[File]]] = []
+    total_length = total_size = 0
+    for embed, file in previews:
+        size = 0 if file is None else file.fp.getbuffer().nbytes
+        if batch and (
+            len(batch) == MAX_EMBEDS_PER_MESSAGE
+            or total_length + len(embed) > MAX_EMBEDS_TOTAL_LENGTH
+            or total_size + size > filesize_limit
+        ):
+            yield batch
+            batch, total_length, total_size = [], 0, 0
+        batch.append((embed, file))
+        total_length += len(embed)
+        total_size += size
+    if batch:
+        yield batch
+
+
+async def send_previews(
+    channel: Messageable, previews: list[tuple[Embed, Optional[File]]]
+) -> None:
+    try:
+        await channel.send(
+            embeds=[embed for embed, _ in previews],
+            files=[file for _, file in previews if file is not None],
+        )
+    except HTTPException:
+        if len(previews) == 1:
+            return
+        # まとめて送れなかったときは、1 ページずつ送り直して送れるものだけでも送る
+        for embed, file in previews:
+            if file is not None:
+                file.reset()
+            try:
+                await channel.send(embed=embed, file=file)
+            except HTTPException:
+                pass
 
 
 async def on_message(message: Message) -> None:
-    if len(gsnet_urls := get_gsnet_urls(message.content)) == 0:
+    # 大半のメッセージは正規表現まで行かずに弾く
+    if "http://10." not in message.content:
+        return
+    gsnet_urls = list(dict.fromkeys(get_gsnet_urls(message.content)))  # 重複を除く
+    if len(gsnet_urls) == 0:
         return
     all_pages = await asyncio.gather(*[get_page(url) for url in gsnet_urls])
     found_pages = filter(None, all_pages)
     page_infos = list(map(lambda p: p.get_info(), found_pages))
     page_embeds = list(map(lambda i: i.to_embed(), page_infos))
 
-    for embed, info in zip(page_embeds, page_infos):
-        temp_dir = tempfile.TemporaryDirectory()
-
-        if info.image_url is not None:
-            try:
-                file = get_ogp_file(info.image_url, Path(temp_dir.name))
-                embed.set_image(url=f"attachment://{file.filename}")
-            except:
-                file = None
-
-        else:
-            try:
-                file = get_png_favicon_file(info.favicon_url, Path(temp_dir.name))
-                embed.set_thumbnail(url=f"attachment://{file.filename}")
-            except:
-                file = None
-
-        await message.channel.send(embed=embed, file=file)
-
-        temp_dir.cleanup()
+    files = await asyncio.gather(
+        *[
+            attach_file(embed, info, i)
+            for i, (embed, info) in enumerate(zip(page_embeds, page_infos))
+        ]
+    )
+    if message.guild is not None:
+        filesize_limit = message.guild.filesize_limit
+    else:
+        filesize_limit = DEFAULT_FILESIZE_LIMIT
+    for previews in split_previews(list(zip(page_embeds, files)), filesize_limit):
+        await send_previews(message.channel, previews)
 
 
 def setup(bot: Bot):
     bot.add_listener(on_message)
+
+
+def teardown(bot: Bot) -> None:
+    # Bot.close() でも拡張はアンロードされるので、終了時もここで閉じられる
+    bot.loop.create_task(session_holder.close())